@@ -24,11 +24,28 @@ class FakeClock:
         clk.set(datetime(2025, 1, 1, tzinfo=timezone.utc))
     """
     _current: datetime = datetime(2000, 1, 1, 0, 0, 0, 0, tzinfo=timezone.utc)
+    _iso: Optional[str] = None
 
     def now(self) -> datetime:
         """retorna o instante atual do relogio falso"""
         return self._current
-    
+
+    def now_iso(self) -> str:
+        """
+        retorna o instante atual como ISO-8601 "…mmmZ", memoizado: o relogio
+        so muda via advance()/set(), entao formatar uma vez por instante basta
+        (testes chamam now varias vezes por operacao de fila)
+        """
+        if self._iso is None:
+            t = self._current
+            self._iso = (
+                f"{t.year:04d}-{t.month:02d}-{t.day:02d}T"
+                f"{t.hour:02d}:{t.minute:02d}:{t.second:02d}."
+                f"{t.microsecond // 1000:03d}Z"
+            )
+        return self._iso
+
+
     def advance(
             self,
             *,
@@ -42,9 +59,11 @@ class FakeClock:
             days=days, hours=hours, minutes=minutes, seconds=seconds
         )
         self._current = self._current + delta
+        self._iso = None
 
     def set(self, dt: datetime) -> None:
         """define o instante atual do relogio"""
         if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) != timedelta(0):
             raise ValueError("FakeClock.set: espera datetime aware em UTC")
         self._current = dt
+        self._iso = None
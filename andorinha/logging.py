@@ -2,18 +2,56 @@ from __future__ import annotations
 
 import os
 import sys
+import time
 import logging as _logging
 from typing import Optional
 
+
+class _FastIsoFormatter(_logging.Formatter):
+    """
+    Formatter com timestamp ISO-8601 UTC sem strftime por registro.
+
+    O prefixo "YYYY-MM-DDTHH:MM:SS" só muda quando vira o segundo; memoizamos
+    o último prefixo por segundo inteiro e entre registros adjacentes apenas
+    os milissegundos (via %(msecs)03d no fmt) são reformatados.
+    """
+
+    def __init__(self, fmt: Optional[str] = None) -> None:
+        super().__init__(fmt=fmt)
+        self._last_sec: int = -1
+        self._last_prefix: str = ""
+
+    def formatTime(self, record: _logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        sec = int(record.created)
+        if sec != self._last_sec:
+            tm = time.gmtime(sec)
+            self._last_prefix = (
+                f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}"
+                f"T{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}"
+            )
+            self._last_sec = sec
+        return self._last_prefix
+
+# Mapa precomputado no import: evita getattr + try/except por chamada.
+# Inclui os aliases do stdlib (WARN/FATAL/NOTSET) que o getattr original
+# resolvia — o atalho não pode estreitar os valores aceitos.
+_LEVEL_MAP = {
+    "DEBUG": _logging.DEBUG,
+    "INFO": _logging.INFO,
+    "WARNING": _logging.WARNING,
+    "WARN": _logging.WARNING,
+    "ERROR": _logging.ERROR,
+    "CRITICAL": _logging.CRITICAL,
+    "FATAL": _logging.CRITICAL,
+    "NOTSET": _logging.NOTSET,
+}
+
 def _parse_level(level: Optional[str]) -> int:
     if isinstance(level, int):
         return level
     if level is None:
         level = os.getenv("ANDORINHA_LOG_LEVEL", "INFO")
-    try:
-        return getattr(_logging, str(level).upper())
-    except AttributeError:
-        return _logging.INFO
+    return _LEVEL_MAP.get(str(level).upper(), _logging.INFO)
     
 def setup_logger(name: str = "andorinha", level: Optional[str | int] = None) -> _logging.Logger:
     """
@@ -33,9 +71,8 @@ def setup_logger(name: str = "andorinha", level: Optional[str | int] = None) ->
     if needs_handler:
         handler = _logging.StreamHandler(stream=sys.stdout)
         # Ex.: 2025-08-14T12:34:56.123Z [INFO] andorinha: mensagem
-        formatter = _logging.Formatter(
+        formatter = _FastIsoFormatter(
             fmt="%(asctime)s.%(msecs)03dZ [%(levelname)s] %(name)s: %(message)s",
-            datefmt="%Y-%m-%dT%H:%M:%S",
         )
         handler.setFormatter(formatter)
         lg.addHandler(handler)
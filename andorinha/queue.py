@@ -3,25 +3,174 @@ from __future__ import annotations
 import json
 import sqlite3
 from datetime import datetime, timedelta
-from typing import Any, Optional, Dict
+from typing import Optional
 
-from .storage import get_conn, utc_now_str
+from .storage import connection, transaction, _writer_lock
 from .clock import now as real_now
 
 
 def _fmt_iso(dt: datetime) -> str:
-    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    # Formata "YYYY-MM-DDTHH:MM:SS.mmmZ" sem strftime (bem mais barato no hot path).
+    return (
+        f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+        f"T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+        f".{dt.microsecond // 1000:03d}Z"
+    )
 
 
-def _iso_after(seconds: int, *, now_fn=real_now) -> str:
-    t = now_fn()
-    t2 = t + timedelta(seconds=seconds)
-    return _fmt_iso(t2)
+def _iso_after(t: datetime, seconds: int) -> str:
+    # Deriva "t + seconds" de um datetime já obtido — evita reentrar no relógio.
+    return _fmt_iso(t + timedelta(seconds=seconds))
 
 
 def _parse_iso_z(s: str) -> datetime:
-    # Aceita "YYYY-MM-DDTHH:MM:SS.mmmZ"
-    return datetime.fromisoformat(s.replace("Z", "+00:00"))
+    # Aceita "YYYY-MM-DDTHH:MM:SS.mmmZ"; o sufixo tem posição fixa, então
+    # fatiar ("[:-1]") evita o scan+alocação do str.replace.
+    return datetime.fromisoformat(s[:-1] + "+00:00")
+
+
+def _ms(dt: datetime) -> int:
+    # Epoch em milissegundos (UTC) — chave de comparação dos caminhos quentes.
+    return int(dt.timestamp() * 1000)
+
+
+def _iso_to_ms(s: Optional[str]) -> Optional[int]:
+    # Converte timestamp ISO-Z opcional (vindo do chamador) para epoch-ms.
+    return None if s is None else _ms(_parse_iso_z(s))
+
+
+def _payload_text(payload) -> Optional[str]:
+    # Caminho comum primeiro: produtores que já serializam (o padrão em
+    # workers) não pagam json.dumps; só objetos caem no dumps. isinstance,
+    # não type() is: subclasses de str devem ser gravadas como estão.
+    if payload is None or isinstance(payload, str):
+        return payload
+    return json.dumps(payload)
+
+
+# --- SQL dos caminhos quentes ---
+# Constantes de módulo: o sqlite3 do CPython mantém um LRU de statements
+# preparados por conexão keyed pelo texto do SQL; strings idênticas em cada
+# chamada garantem hit no cache (sem reparse/replan por chamada).
+
+_SQL_INSERT_JOB = """INSERT INTO jobs(status, priority, queue, payload, attempt, max_attempts,
+                    scheduled_at, lease_expires_at, rate_group, cron, next_run_at,
+                    created_at, updated_at,
+                    scheduled_at_ms, lease_expires_at_ms, created_at_ms, updated_at_ms)
+   VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);"""
+
+# Os LIMITs são parâmetros (?) para que o mesmo texto sirva ao dequeue
+# unitário e ao em lote — uma única entrada no LRU de statements.
+# Ordenação por poll_key (coluna gerada priority*1e13 + created_at_ms, v3):
+# comparação de um único inteiro no lugar do comparador de duas colunas, e o
+# braço 'queued' sem filtro de fila sai direto de idx_jobs_pollkey.
+_SQL_DEQUEUE_ANY = """
+SELECT id FROM (
+    SELECT * FROM (
+        SELECT id, poll_key FROM jobs
+        WHERE status='queued' AND (scheduled_at_ms IS NULL OR scheduled_at_ms <= ?)
+        ORDER BY poll_key ASC
+        LIMIT ?
+    )
+    UNION ALL
+    SELECT * FROM (
+        SELECT id, poll_key FROM jobs
+        WHERE status='leased' AND lease_expires_at_ms IS NOT NULL AND lease_expires_at_ms <= ?
+        ORDER BY poll_key ASC
+        LIMIT ?
+    )
+)
+ORDER BY poll_key ASC
+LIMIT ?;
+"""
+
+# No braço 'queued' com filtro de fila, o ORDER BY fica em
+# (priority, created_at_ms): é a ordem que idx_jobs_ready entrega com
+# queue fixa — e equivale à ordem de poll_key — enquanto "ORDER BY
+# poll_key" forçaria um sort, já que o planner não enxerga a equivalência.
+_SQL_DEQUEUE_Q = """
+SELECT id FROM (
+    SELECT * FROM (
+        SELECT id, poll_key FROM jobs
+        WHERE status='queued' AND (scheduled_at_ms IS NULL OR scheduled_at_ms <= ?)
+          AND queue = ?
+        ORDER BY priority ASC, created_at_ms ASC
+        LIMIT ?
+    )
+    UNION ALL
+    SELECT * FROM (
+        SELECT id, poll_key FROM jobs
+        WHERE status='leased' AND lease_expires_at_ms IS NOT NULL AND lease_expires_at_ms <= ?
+          AND queue = ?
+        ORDER BY poll_key ASC
+        LIMIT ?
+    )
+)
+ORDER BY poll_key ASC
+LIMIT ?;
+"""
+
+# Template do claim: {ids} é expandido para a lista de placeholders dos ids
+# candidatos. Com lote de tamanho fixo (1 no dequeue unitário) o texto gerado
+# é estável e continua aproveitando o cache de statements.
+_SQL_UPDATE_LEASE_TMPL = """
+UPDATE jobs
+SET status='leased',
+    lease_expires_at=?,
+    lease_expires_at_ms=?,
+    updated_at=?,
+    updated_at_ms=?
+WHERE id IN ({ids})
+  AND (
+    (status='queued' AND (scheduled_at_ms IS NULL OR scheduled_at_ms <= ?))
+    OR
+    (status='leased' AND lease_expires_at_ms IS NOT NULL AND lease_expires_at_ms <= ?)
+  )
+RETURNING *;
+"""
+
+# Variante sem payload: jobs com payload grande não são materializados em
+# Python quando o chamador só quer os metadados (o payload pode ser buscado
+# depois com SELECT payload FROM jobs WHERE id=?).
+_SQL_UPDATE_LEASE_META_TMPL = _SQL_UPDATE_LEASE_TMPL.replace(
+    "RETURNING *;",
+    """RETURNING id, status, priority, queue, attempt, max_attempts,
+         scheduled_at, lease_expires_at, rate_group, cron, next_run_at,
+         created_at, updated_at,
+         scheduled_at_ms, lease_expires_at_ms, created_at_ms, updated_at_ms,
+         poll_key;""",
+)
+
+_SQL_EXTEND_LEASE = """
+UPDATE jobs
+SET lease_expires_at_ms = lease_expires_at_ms + ?1,
+    lease_expires_at = strftime('%Y-%m-%dT%H:%M:%f',
+                                (lease_expires_at_ms + ?1) / 1000.0,
+                                'unixepoch') || 'Z',
+    updated_at = ?2,
+    updated_at_ms = ?3
+WHERE id = ?4
+  AND status='leased'
+  AND lease_expires_at_ms IS NOT NULL
+  AND lease_expires_at_ms > ?3;
+"""
+
+# Um único statement para sucesso e falha (?1 = 1 para sucesso): uma entrada
+# no LRU de statements em vez de duas, sem branch em Python.
+_SQL_RELEASE = """
+UPDATE jobs
+SET status = CASE ?1 WHEN 1 THEN 'succeeded' ELSE 'queued' END,
+    attempt = attempt + CASE ?1 WHEN 1 THEN 0 ELSE 1 END,
+    lease_expires_at = NULL,
+    lease_expires_at_ms = NULL,
+    updated_at = ?2,
+    updated_at_ms = ?3,
+    -- na falha, reencaminha imediatamente (sem backoff por enquanto)
+    scheduled_at = CASE ?1 WHEN 1 THEN scheduled_at ELSE COALESCE(scheduled_at, ?2) END,
+    scheduled_at_ms = CASE ?1 WHEN 1 THEN scheduled_at_ms ELSE COALESCE(scheduled_at_ms, ?3) END
+WHERE id = ?4
+  AND status = 'leased';
+"""
 
 
 def enqueue(
@@ -41,118 +190,193 @@ def enqueue(
     Insere um job em status 'queued'. Retorna o id do job.
     Todos os timestamps são UTC (ISO-8601 com 'Z').
     """
-    conn = get_conn(db_path)
-    created = utc_now_str() if now_fn is real_now else _fmt_iso(now_fn())
-    updated = created
-    payload_str = payload if (payload is None or isinstance(payload, str)) else json.dumps(payload)
-    conn.execute("BEGIN IMMEDIATE;")
-    try:
-        cur = conn.execute(
-            """INSERT INTO jobs(status, priority, queue, payload, attempt, max_attempts,
-                                scheduled_at, lease_expires_at, rate_group, cron, next_run_at,
-                                created_at, updated_at)
-               VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?);""",
+    t = now_fn()
+    created = _fmt_iso(t)
+    created_ms = _ms(t)
+    payload_str = _payload_text(payload)
+    with _writer_lock(db_path), connection(db_path) as conn:
+        with transaction(conn):
+            cur = conn.execute(
+                _SQL_INSERT_JOB,
+                (
+                    "queued",
+                    int(priority),
+                    str(queue),
+                    payload_str,
+                    0,
+                    int(max_attempts),
+                    scheduled_at,
+                    None,
+                    rate_group,
+                    cron,
+                    next_run_at,
+                    created,
+                    created,
+                    _iso_to_ms(scheduled_at),
+                    None,
+                    created_ms,
+                    created_ms,
+                ),
+            )
+            job_id = cur.lastrowid
+        return int(job_id)
+
+
+def enqueue_many(
+    jobs: list,
+    *,
+    db_path: Optional[str] = None,
+    now_fn=real_now,
+) -> list:
+    """
+    Insere vários jobs em uma única transação (executemany + 1 commit).
+    Cada item é um dict com as mesmas chaves opcionais de `enqueue`
+    (queue, priority, payload, max_attempts, scheduled_at, rate_group,
+    cron, next_run_at). Retorna os ids na ordem de inserção.
+
+    Amortiza o fsync do commit: N inserts custam 1 fsync em vez de N.
+    Todos os jobs do lote compartilham o mesmo created_at. Payloads devem
+    vir pré-serializados (str ou None) — o caminho em lote não passa por
+    json.dumps por item.
+    """
+    if not jobs:
+        return []
+    t = now_fn()
+    created = _fmt_iso(t)
+    created_ms = _ms(t)
+    rows = []
+    for j in jobs:
+        payload = j.get("payload")
+        if not (payload is None or isinstance(payload, str)):
+            raise TypeError("enqueue_many: payload deve ser str pré-serializada ou None")
+        scheduled = j.get("scheduled_at")
+        rows.append(
             (
                 "queued",
-                int(priority),
-                str(queue),
-                payload_str,
+                int(j.get("priority", 0)),
+                str(j.get("queue", "default")),
+                payload,
                 0,
-                int(max_attempts),
-                scheduled_at,
+                int(j.get("max_attempts", 1)),
+                scheduled,
                 None,
-                rate_group,
-                cron,
-                next_run_at,
+                j.get("rate_group"),
+                j.get("cron"),
+                j.get("next_run_at"),
                 created,
-                updated,
-            ),
+                created,
+                _iso_to_ms(scheduled),
+                None,
+                created_ms,
+                created_ms,
+            )
         )
-        job_id = cur.lastrowid
-        conn.commit()
-        return int(job_id)
-    except Exception:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        raise
+    with _writer_lock(db_path), connection(db_path) as conn:
+        with transaction(conn):
+            conn.executemany(_SQL_INSERT_JOB, rows)
+            last = int(conn.execute("SELECT last_insert_rowid();").fetchone()[0])
+        # rowids dentro da mesma transação são contíguos: [last-n+1 .. last]
+        return list(range(last - len(rows) + 1, last + 1))
 
 
-def dequeue_with_lease(
+def dequeue_batch(
+    batch_size: int,
     lease_ttl_sec: int,
     *,
     db_path: Optional[str] = None,
     queue: Optional[str] = None,
+    fetch_payload: bool = True,
     now_fn=real_now,
-) -> Optional[Dict[str, Any]]:
+) -> list:
     """
-    Seleciona 1 job disponível (status='queued' e agendado, ou 'leased' expirado)
-    obedecendo a ordenação (priority ASC, created_at ASC), marca como 'leased'
-    com novo lease (TTL) e retorna o registro como dict. Se não houver, retorna None.
+    Reivindica até `batch_size` jobs disponíveis em uma única transação,
+    obedecendo a ordenação (priority ASC, created_at ASC), marca todos como
+    'leased' com o mesmo lease (TTL) e retorna as linhas em ordem de
+    prioridade. Lista vazia se não houver nada disponível.
+
+    Amortiza BEGIN/COMMIT (e o fsync do commit) sobre N jobs — o custo por
+    job cai ~N vezes para workers de alta vazão.
     """
-    conn = get_conn(db_path)
-    now_str = utc_now_str() if now_fn is real_now else _fmt_iso(now_fn())
-    lease_exp = _iso_after(lease_ttl_sec, now_fn=now_fn)
+    if batch_size <= 0:
+        return []
+    # Um único now_fn() por operação; tudo deriva do mesmo instante.
+    t = now_fn()
+    now_str = _fmt_iso(t)
+    now_ms = _ms(t)
+    lease_exp = _iso_after(t, lease_ttl_sec)
+    lease_exp_ms = now_ms + lease_ttl_sec * 1000
+    n = int(batch_size)
 
-    conn.execute("BEGIN IMMEDIATE;")
-    try:
+    with connection(db_path) as conn:
+        # 1) Sondagem dos candidatos FORA de transação: leitura pura em WAL,
+        #    sem adquirir lock RESERVED. Fila vazia = nenhum BEGIN/COMMIT
+        #    (caso comum de workers em polling). Candidatos vêm do UNION ALL
+        #    de dois braços LIMIT n, cada um cobrindo um índice parcial
+        #    (idx_jobs_ready / idx_jobs_leased_exp); o ORDER BY externo ordena
+        #    no máximo 2n linhas.
         if queue is None:
-            sel = conn.execute(
-                """
-                SELECT id FROM jobs
-                WHERE
-                  (
-                    (status='queued' AND (scheduled_at IS NULL OR scheduled_at <= ?))
-                    OR
-                    (status='leased' AND lease_expires_at IS NOT NULL AND lease_expires_at <= ?)
-                  )
-                ORDER BY priority ASC, created_at ASC
-                LIMIT 1;
-                """,
-                (now_str, now_str),
-            ).fetchone()
+            cands = conn.execute(_SQL_DEQUEUE_ANY, (now_ms, n, now_ms, n, n)).fetchall()
         else:
-            sel = conn.execute(
-                """
-                SELECT id FROM jobs
-                WHERE
-                  (
-                    (status='queued' AND (scheduled_at IS NULL OR scheduled_at <= ?))
-                    OR
-                    (status='leased' AND lease_expires_at IS NOT NULL AND lease_expires_at <= ?)
-                  )
-                  AND queue = ?
-                ORDER BY priority ASC, created_at ASC
-                LIMIT 1;
-                """,
-                (now_str, now_str, queue),
-            ).fetchone()
-
-        if not sel:
-            conn.commit()
-            return None
-
-        job_id = int(sel["id"])
-        conn.execute(
-            """
-            UPDATE jobs
-            SET status='leased',
-                lease_expires_at=?,
-                updated_at=?
-            WHERE id=?;
-            """,
-            (lease_exp, now_str, job_id),
-        )
-        row = conn.execute("SELECT * FROM jobs WHERE id=?;", (job_id,)).fetchone()
-        conn.commit()
-        return dict(row)
-    except Exception:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        raise
+            cands = conn.execute(
+                _SQL_DEQUEUE_Q, (now_ms, queue, n, now_ms, queue, n, n)
+            ).fetchall()
+
+        if not cands:
+            return []
+        # Acesso posicional: id é a única coluna projetada; evita o scan de
+        # nomes de coluna do sqlite3.Row.__getitem__ por candidato.
+        ids = [int(c[0]) for c in cands]
+
+        # 2) Só agora escalamos para escrita. O UPDATE re-checa o predicado de
+        #    disponibilidade no WHERE (double-check) para sobreviver a
+        #    corridas: jobs levados por outro worker ficam fora do RETURNING.
+        tmpl = _SQL_UPDATE_LEASE_TMPL if fetch_payload else _SQL_UPDATE_LEASE_META_TMPL
+        sql = tmpl.format(ids=",".join("?" * len(ids)))
+        # Escritores do mesmo processo serializam no mutex por db_path em vez
+        # de colidir no lock do arquivo (SQLITE_BUSY + espera do busy_timeout).
+        # A sondagem acima fica fora do mutex de propósito: leitura em WAL.
+        with _writer_lock(db_path):
+            with transaction(conn):
+                rows = conn.execute(
+                    sql,
+                    (lease_exp, lease_exp_ms, now_str, now_ms, *ids, now_ms, now_ms),
+                ).fetchall()
+        # RETURNING não garante ordem; restaura via poll_key (chave única).
+        rows.sort(key=lambda r: r["poll_key"])
+        return rows
+
+
+def dequeue_with_lease(
+    lease_ttl_sec: int,
+    *,
+    db_path: Optional[str] = None,
+    queue: Optional[str] = None,
+    fetch_payload: bool = True,
+    now_fn=real_now,
+) -> Optional[sqlite3.Row]:
+    """
+    Seleciona 1 job disponível (status='queued' e agendado, ou 'leased' expirado)
+    obedecendo a ordenação (priority ASC, created_at ASC), marca como 'leased'
+    com novo lease (TTL) e retorna a linha (sqlite3.Row, acesso por nome como
+    um dict). Se não houver, retorna None.
+
+    Com fetch_payload=False a linha retornada não inclui 'payload' — útil para
+    despachantes que só roteiam metadados e evita copiar payloads grandes.
+    Nesse caso row['payload'] levanta IndexError (semântica do sqlite3.Row
+    para coluna ausente); use 'payload' in row.keys() para detectar, ou busque
+    depois com SELECT payload FROM jobs WHERE id=?.
+    """
+    rows = dequeue_batch(
+        1,
+        lease_ttl_sec,
+        db_path=db_path,
+        queue=queue,
+        fetch_payload=fetch_payload,
+        now_fn=now_fn,
+    )
+    # Devolve a sqlite3.Row direto: evita hash/cópia de 17 colunas por
+    # dequeue só para montar um dict que o chamador indexa por nome.
+    return rows[0] if rows else None
 
 
 def extend_lease(
@@ -167,46 +391,20 @@ def extend_lease(
     desde que o job ainda esteja 'leased' e que o lease **não tenha expirado**.
     Retorna True se atualizado; False caso contrário.
     """
-    conn = get_conn(db_path)
-    now_str = utc_now_str() if now_fn is real_now else _fmt_iso(now_fn())
-
-    conn.execute("BEGIN IMMEDIATE;")
-    try:
-        row = conn.execute(
-            """
-            SELECT lease_expires_at FROM jobs
-            WHERE id = ?
-              AND status='leased'
-              AND lease_expires_at IS NOT NULL
-              AND lease_expires_at > ?;
-            """,
-            (int(job_id), now_str),
-        ).fetchone()
-
-        if not row:
-            conn.commit()
-            return False
-
-        old_exp = _parse_iso_z(row["lease_expires_at"])
-        new_exp = old_exp + timedelta(seconds=add_ttl_sec)
-
-        conn.execute(
-            """
-            UPDATE jobs
-            SET lease_expires_at = ?,
-                updated_at = ?
-            WHERE id = ?;
-            """,
-            (_fmt_iso(new_exp), now_str, int(job_id)),
-        )
-        conn.commit()
-        return True
-    except Exception:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        raise
+    t = now_fn()
+    now_str = _fmt_iso(t)
+    now_ms = _ms(t)
+
+    with _writer_lock(db_path), connection(db_path) as conn:
+        with transaction(conn):
+            # UPDATE condicional único: a soma é aritmética inteira em epoch-ms
+            # (sem SELECT prévio nem parse de ISO); a coluna TEXT é ressincronizada
+            # pelo próprio SQLite via strftime sobre o novo valor.
+            cur = conn.execute(
+                _SQL_EXTEND_LEASE,
+                (add_ttl_sec * 1000, now_str, now_ms, int(job_id)),
+            )
+        return cur.rowcount == 1
 
 
 def release(
@@ -215,47 +413,23 @@ def release(
     success: bool,
     db_path: Optional[str] = None,
     now_fn=real_now,
-) -> None:
+) -> bool:
     """
     Finaliza o lease do job:
       - success=True  -> status='succeeded', limpa lease, atualiza timestamp
       - success=False -> status='queued', attempt=attempt+1, limpa lease, volta para fila
     (Backoff será integrado no passo 4.)
+
+    Só age sobre jobs 'leased': release repetido/atrasado é no-op (nenhuma
+    página suja, nenhum frame de WAL) e retorna False.
     """
-    conn = get_conn(db_path)
-    now_str = utc_now_str() if now_fn is real_now else _fmt_iso(now_fn())
-
-    conn.execute("BEGIN IMMEDIATE;")
-    try:
-        if success:
-            conn.execute(
-                """
-                UPDATE jobs
-                SET status='succeeded',
-                    lease_expires_at=NULL,
-                    updated_at=?
-                WHERE id=?;
-                """,
-                (now_str, int(job_id)),
-            )
-        else:
-            conn.execute(
-                """
-                UPDATE jobs
-                SET status='queued',
-                    attempt=attempt+1,
-                    lease_expires_at=NULL,
-                    updated_at=?,
-                    -- reencaminha imediatamente (sem backoff por enquanto)
-                    scheduled_at=COALESCE(scheduled_at, ?)
-                WHERE id=?;
-                """,
-                (now_str, now_str, int(job_id)),
+    t = now_fn()
+    now_str = _fmt_iso(t)
+    now_ms = _ms(t)
+
+    with _writer_lock(db_path), connection(db_path) as conn:
+        with transaction(conn):
+            cur = conn.execute(
+                _SQL_RELEASE, (1 if success else 0, now_str, now_ms, int(job_id))
             )
-        conn.commit()
-    except Exception:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        raise
\ No newline at end of file
+        return cur.rowcount == 1
\ No newline at end of file
@@ -3,16 +3,45 @@ from __future__ import annotations
 import os
 import sqlite3
 import threading
-from datetime import datetime, timezone
-
-from .clock import now
+import time
+from contextlib import contextmanager
 
 # --- Conexões por thread ---
 # Cada thread mantém um dict {db_path: sqlite3.Connection}
 _thread_state = threading.local()
 
+# --- Pool de conexões por processo ---
+# Lista LIFO de conexões livres por db_path, compartilhada entre threads
+# (check_same_thread=False). Reusar a mesma conexão entre threads mantém o
+# page cache e o LRU de statements preparados quentes, em vez de N caches
+# frios para N threads.
+_pools_lock = threading.Lock()
+_pools: dict[str, list[sqlite3.Connection]] = {}
+
+# --- Serialização de escritores no processo ---
+# SQLite admite um escritor por vez; sem isto, threads concorrentes disputam
+# o lock do arquivo e queimam CPU/latência no ciclo SQLITE_BUSY + retry do
+# busy_timeout. Um mutex por db_path converte essa disputa em handoff barato
+# dentro do processo. Leituras (WAL) seguem sem lock.
+_writers_lock = threading.Lock()
+_writers: dict[str, threading.Lock] = {}
+
+def _writer_lock(db_path: str | None = None) -> threading.Lock:
+    path = db_path or DEFAULT_DB
+    with _writers_lock:
+        lk = _writers.get(path)
+        if lk is None:
+            lk = threading.Lock()
+            _writers[path] = lk
+        return lk
+
 DEFAULT_DB = os.getenv("ANDORINHA_DB", os.path.join(os.getcwd(), "andorinha.db"))
 
+# Tamanho do LRU de statements preparados do sqlite3 (por conexão). As
+# queries quentes vivem como constantes de módulo em queue.py, então cada
+# texto de SQL vira uma entrada estável aqui e nunca é recompilado.
+_STMT_CACHE_SIZE = 256
+
 def _ensure_thread_dict() -> dict:
     d = getattr(_thread_state, "conns", None)
     if d is None:
@@ -22,12 +51,24 @@ def _ensure_thread_dict() -> dict:
 
 def utc_now_str() -> str:
     """Retorna timestamp UTC ISO-8601 com milissegundos e sufixo 'Z'."""
-    t = now()
-    # yyyy-mm-ddTHH:MM:SS.mmmZ
-    return t.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    # time.time_ns() -> inteiros -> f-string: sem construir datetime nenhum.
+    # (clock.now()/FakeClock continuam sendo o caminho dos testes em queue.py.)
+    s, rem = divmod(time.time_ns(), 1_000_000_000)
+    ms = rem // 1_000_000
+    tm = time.gmtime(s)
+    return (
+        f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}"
+        f"T{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}"
+        f".{ms:03d}Z"
+    )
+
+def utc_now_ms() -> int:
+    """Retorna o instante atual em epoch-ms UTC (par inteiro de utc_now_str)."""
+    return time.time_ns() // 1_000_000
 
 def _configure_connection(conn: sqlite3.Connection) -> None:
-    conn.row_factory = sqlite3.Row
+    # Rodada única por conexão (get_conn só chama na criação; conexões já
+    # cacheadas não reexecutam PRAGMAs).
     # transações explícitas (BEGIN/COMMIT) quando necessário
     conn.isolation_level = None  # autocommit; usamos BEGIN IMMEDIATE manualmente
     # PRAGMAs por conexão
@@ -36,6 +77,19 @@ def _configure_connection(conn: sqlite3.Connection) -> None:
     mode = conn.execute("PRAGMA journal_mode = WAL;").fetchone()[0]
     if str(mode).lower() != "wal":
         raise RuntimeError(f"Falha ao ativar WAL, journal_mode={mode!r}")
+    # Ajustes para carga de fila (muitos commits pequenos):
+    # - synchronous=NORMAL em WAL corta um fsync por commit e continua
+    #   crash-safe (pode-se forçar FULL via ANDORINHA_SQLITE_SYNC).
+    # - checkpoint menos frequente, cache/scratch maiores, leitura via mmap.
+    sync = os.getenv("ANDORINHA_SQLITE_SYNC", "NORMAL").upper()
+    if sync not in ("NORMAL", "FULL"):
+        sync = "NORMAL"
+    conn.execute(f"PRAGMA synchronous = {sync};")
+    conn.execute("PRAGMA wal_autocheckpoint = 2000;")
+    conn.execute("PRAGMA cache_size = -65536;")       # 64 MiB de page cache
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")     # 256 MiB
+    conn.row_factory = sqlite3.Row
 
 def get_conn(db_path: str | None = None) -> sqlite3.Connection:
     """
@@ -46,19 +100,114 @@ def get_conn(db_path: str | None = None) -> sqlite3.Connection:
     conns = _ensure_thread_dict()
     conn = conns.get(db_path)
     if conn is None:
-        conn = sqlite3.connect(db_path, check_same_thread=True)
+        conn = sqlite3.connect(
+            db_path, check_same_thread=True, cached_statements=_STMT_CACHE_SIZE
+        )
         _configure_connection(conn)
         conns[db_path] = conn
     return conn
 
+@contextmanager
+def transaction(conn: sqlite3.Connection, *, defer_fk: bool = False):
+    """
+    Transação IMMEDIATE explícita com commit/rollback automáticos.
+
+    Com defer_fk=True, 'PRAGMA defer_foreign_keys=ON' adia a validação de
+    FKs para o COMMIT — útil para escritores em lote de `runs`, onde o
+    lookup de FK por linha inserida domina o custo. O pragma reseta sozinho
+    no fim da transação, então o comportamento padrão (FK imediato) fica
+    intacto para o resto da conexão.
+    """
+    conn.execute("BEGIN IMMEDIATE;")
+    if defer_fk:
+        conn.execute("PRAGMA defer_foreign_keys=ON;")
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+
+def _close_optimized(conn: sqlite3.Connection) -> None:
+    # "PRAGMA optimize" antes de fechar: re-analisa só o que mudou o
+    # suficiente, mantendo as estatísticas do planner frescas a custo baixo
+    # (recomendação da própria documentação do SQLite).
+    try:
+        conn.execute("PRAGMA optimize;")
+    except Exception:
+        pass
+    conn.close()
+
+def checkpoint(db_path: str | None = None) -> None:
+    """
+    Força 'PRAGMA wal_checkpoint(TRUNCATE)': aplica o WAL no banco e trunca
+    o arquivo. Workers de longa duração devem chamar periodicamente (ex.: a
+    cada N jobs) para o WAL não crescer sem limite; a cadência fica a cargo
+    do chamador — a biblioteca não agenda threads por conta própria.
+    """
+    with connection(db_path) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+@contextmanager
+def connection(db_path: str | None = None):
+    """
+    Empresta uma conexão do pool do processo para 'db_path' (ou DEFAULT_DB)
+    e a devolve ao sair do bloco. Uso:
+
+        with connection(db_path) as conn:
+            conn.execute(...)
+
+    A conexão é criada com check_same_thread=False; a exclusão mútua fica a
+    cargo do lock de escrita do SQLite (WAL) — cada empréstimo é exclusivo,
+    então nunca há duas threads na mesma conexão ao mesmo tempo.
+    """
+    db_path = db_path or DEFAULT_DB
+    conn = None
+    with _pools_lock:
+        free = _pools.get(db_path)
+        if free:
+            conn = free.pop()
+    if conn is None:
+        conn = sqlite3.connect(
+            db_path, check_same_thread=False, cached_statements=_STMT_CACHE_SIZE
+        )
+        _configure_connection(conn)
+    try:
+        yield conn
+    finally:
+        with _pools_lock:
+            _pools.setdefault(db_path, []).append(conn)
+
 def close_thread_connections() -> None:
-    """Fecha todas as conexões mantidas pelo thread atual."""
+    """
+    Fecha as conexões mantidas pelo thread atual e drena o pool do processo.
+    (Usado nos tearDown dos testes para não vazar handles entre bancos.)
+    """
     conns = _ensure_thread_dict()
     for path, c in list(conns.items()):
         try:
-            c.close()
+            _close_optimized(c)
         finally:
             conns.pop(path, None)
+    with _pools_lock:
+        for path, free in list(_pools.items()):
+            for c in free:
+                try:
+                    _close_optimized(c)
+                except Exception:
+                    pass
+            _pools.pop(path, None)
+
+def close_all_connections() -> None:
+    """
+    Fecha todas as conexões do processo (pool compartilhado + thread atual).
+    Nome preferido para shutdown de workers; conexões thread-local de OUTROS
+    threads seguem sob responsabilidade de cada thread.
+    """
+    close_thread_connections()
 
 # --- Migração (schema v1) ---
 
@@ -128,6 +277,80 @@ CREATE INDEX IF NOT EXISTS idx_runs_job_id
     ON runs(job_id);
 """
 
+SCHEMA_V2 = """
+-- v2: espelhos em epoch-ms (INTEGER) dos timestamps TEXT: comparação e
+-- ordenação do dequeue usam inteiros de 8 bytes em vez de memcmp de
+-- 24 bytes; os índices ficam mais densos. As colunas TEXT seguem como
+-- registro legível.
+ALTER TABLE jobs ADD COLUMN scheduled_at_ms     INTEGER;
+ALTER TABLE jobs ADD COLUMN lease_expires_at_ms INTEGER;
+ALTER TABLE jobs ADD COLUMN created_at_ms       INTEGER;
+ALTER TABLE jobs ADD COLUMN updated_at_ms       INTEGER;
+
+-- Backfill a partir do TEXT "YYYY-MM-DDTHH:MM:SS.mmmZ": segundos via
+-- strftime('%s') + milissegundos pelo sufixo de posição fixa (substr 21,3).
+-- NULL propaga: scheduled_at/lease_expires_at ausentes continuam NULL.
+UPDATE jobs SET
+    scheduled_at_ms     = CAST(strftime('%s', scheduled_at) AS INTEGER) * 1000
+                          + CAST(substr(scheduled_at, 21, 3) AS INTEGER),
+    lease_expires_at_ms = CAST(strftime('%s', lease_expires_at) AS INTEGER) * 1000
+                          + CAST(substr(lease_expires_at, 21, 3) AS INTEGER),
+    created_at_ms       = CAST(strftime('%s', created_at) AS INTEGER) * 1000
+                          + CAST(substr(created_at, 21, 3) AS INTEGER),
+    updated_at_ms       = CAST(strftime('%s', updated_at) AS INTEGER) * 1000
+                          + CAST(substr(updated_at, 21, 3) AS INTEGER);
+
+-- Índices parciais casando com os dois braços do predicado de dequeue:
+-- um para 'queued' (já na ordem de ordenação) e um para lease expirado.
+-- scheduled_at_ms no fim torna idx_jobs_ready cobridor: o braço 'queued'
+-- resolve filtro + ordenação + projeção sem tocar a tabela principal.
+CREATE INDEX IF NOT EXISTS idx_jobs_ready
+    ON jobs(queue, priority, created_at_ms, scheduled_at_ms)
+    WHERE status='queued';
+CREATE INDEX IF NOT EXISTS idx_jobs_leased_exp
+    ON jobs(lease_expires_at_ms)
+    WHERE status='leased';
+
+-- Varredura "qual o próximo agendado?" — complementa idx_jobs_ready
+-- (que ordena por prioridade/criação) com um índice por horário agendado.
+CREATE INDEX IF NOT EXISTS idx_jobs_scheduled
+    ON jobs(scheduled_at_ms)
+    WHERE status='queued' AND scheduled_at_ms IS NOT NULL;
+
+-- Braço 'queued' do dequeue SEM filtro de fila — idx_jobs_ready começa
+-- por queue e não serve o ORDER BY nesse caso; este índice entrega
+-- (priority, created_at_ms) já em ordem, sem temp B-tree.
+CREATE INDEX IF NOT EXISTS idx_jobs_ready_any
+    ON jobs(priority, created_at_ms, scheduled_at_ms)
+    WHERE status='queued';
+
+-- O índice v1 em colunas TEXT fica obsoleto com os parciais acima.
+DROP INDEX IF EXISTS idx_jobs_available;
+"""
+
+SCHEMA_V3 = """
+-- v3: chave de polling empacotada em um único inteiro comparável:
+-- priority * 1e13 + created_at_ms (created_at_ms < 1e13 até ~2286, então a
+-- ordem de poll_key == ordem de (priority, created_at_ms)). VIRTUAL porque
+-- ALTER TABLE não aceita STORED; o valor materializado vive no índice.
+ALTER TABLE jobs ADD COLUMN poll_key INTEGER
+    GENERATED ALWAYS AS (priority * 10000000000000 + created_at_ms) VIRTUAL;
+
+-- Índice parcial de chave única: entradas menores e comparação de um inteiro
+-- só no braço 'queued' sem filtro de fila. Substitui idx_jobs_ready_any.
+CREATE INDEX IF NOT EXISTS idx_jobs_pollkey
+    ON jobs(poll_key) WHERE status='queued';
+
+DROP INDEX IF EXISTS idx_jobs_ready_any;
+"""
+
+# (versão, script) em ordem de aplicação.
+_MIGRATIONS: tuple[tuple[int, str], ...] = (
+    (1, SCHEMA_V1),
+    (2, SCHEMA_V2),
+    (3, SCHEMA_V3),
+)
+
 def _current_version(conn: sqlite3.Connection) -> int:
     row = conn.execute(
         "SELECT name FROM sqlite_master WHERE type='table' AND name='schema_migrations';"
@@ -144,7 +367,8 @@ def migrate(conn: sqlite3.Connection) -> int:
     Usa BEGIN IMMEDIATE + commit/rollback do driver (conn.commit/rollback).
     """
     ver = _current_version(conn)
-    if ver >= 1:
+    latest = _MIGRATIONS[-1][0]
+    if ver >= latest:
         return ver
 
     # Abrir transação explicitamente (em autocommit, precisamos do BEGIN)
@@ -155,10 +379,19 @@ def migrate(conn: sqlite3.Connection) -> int:
         conn.execute("BEGIN;")
 
     try:
-        conn.executescript(SCHEMA_V1)
-        conn.execute("INSERT INTO schema_migrations(version) VALUES (1);")
+        for version, script in _MIGRATIONS:
+            if version <= ver:
+                continue
+            conn.executescript(script)
+            conn.execute(
+                "INSERT INTO schema_migrations(version) VALUES (?);", (version,)
+            )
+        # Estatísticas para o planner logo após criar/alterar índices:
+        # estabiliza a escolha dos índices parciais do dequeue mesmo com a
+        # tabela ainda pequena.
+        conn.execute("ANALYZE;")
         conn.commit()
-        return 1
+        return latest
     except Exception:
         # Garanta que rollback não cause novo erro se a transação já caiu
         try:
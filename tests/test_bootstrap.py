@@ -28,6 +28,16 @@ class TestClock(unittest.TestCase):
             start + timedelta(seconds=30, minutes=1, hours=1, days=1),
         )
 
+    def test_fake_clock_now_iso_memoized_and_invalidated(self):
+        clk = clock.FakeClock()
+        clk.set(datetime(2024, 1, 1, 12, 30, 45, 123000, tzinfo=timezone.utc))
+        s1 = clk.now_iso()
+        self.assertEqual(s1, "2024-01-01T12:30:45.123Z")
+        # Mesma instância enquanto o relógio não anda
+        self.assertIs(clk.now_iso(), s1)
+        clk.advance(seconds=1)
+        self.assertEqual(clk.now_iso(), "2024-01-01T12:30:46.123Z")
+
     def test_fake_clock_set_requires_utc_aware(self):
         clk = clock.FakeClock()
         with self.assertRaises(ValueError):
@@ -57,6 +67,18 @@ class TestLogging(unittest.TestCase):
         finally:
             sys.stdout = original_stdout
 
+    def test_parse_level_accepts_stdlib_aliases(self):
+        import logging as std_logging
+
+        # Os aliases do stdlib (WARN/FATAL/NOTSET) resolvem como no getattr
+        # original; desconhecidos caem em INFO.
+        self.assertEqual(and_logging._parse_level("WARN"), std_logging.WARNING)
+        self.assertEqual(and_logging._parse_level("warn"), std_logging.WARNING)
+        self.assertEqual(and_logging._parse_level("FATAL"), std_logging.CRITICAL)
+        self.assertEqual(and_logging._parse_level("NOTSET"), std_logging.NOTSET)
+        self.assertEqual(and_logging._parse_level("DEBUG"), std_logging.DEBUG)
+        self.assertEqual(and_logging._parse_level("nope"), std_logging.INFO)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
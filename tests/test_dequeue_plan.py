@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from andorinha.clock import FakeClock
+from andorinha.storage import get_conn, migrate, close_thread_connections
+from andorinha.queue import enqueue, _SQL_DEQUEUE_ANY, _SQL_DEQUEUE_Q
+
+
+class TestDequeuePlan(unittest.TestCase):
+    """
+    Trava o plano de execução do dequeue: os braços 'queued' devem ser
+    servidos pelos índices parciais (top-K via índice, não sort completo).
+    Se o planner regredir para full scan, estes testes acusam.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "plan.db")
+        self.conn = get_conn(self.db_path)
+        migrate(self.conn)
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        close_thread_connections()
+        self.tmp.cleanup()
+
+    def _plan(self, sql, params):
+        rows = self.conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        return [str(r[-1]) for r in rows]
+
+    def test_candidate_any_uses_ordered_partial_indexes(self):
+        plan = self._plan(_SQL_DEQUEUE_ANY, (0, 1, 0, 1, 1))
+        joined = " | ".join(plan)
+        self.assertIn("idx_jobs_pollkey", joined)
+        self.assertIn("idx_jobs_leased_exp", joined)
+        # O braço 'queued' (primeiro subquery) deve vir em ordem do índice,
+        # sem temp B-tree entre o SCAN do índice e o consumo do braço.
+        i_scan = next(i for i, p in enumerate(plan) if "idx_jobs_pollkey" in p)
+        self.assertNotIn("TEMP B-TREE", plan[i_scan + 1])
+
+    def test_candidate_by_queue_uses_ready_index(self):
+        plan = self._plan(_SQL_DEQUEUE_Q, (0, "emails", 1, 0, "emails", 1, 1))
+        joined = " | ".join(plan)
+        self.assertIn("idx_jobs_ready", joined)
+        i_scan = next(i for i, p in enumerate(plan) if "idx_jobs_ready" in p)
+        self.assertNotIn("TEMP B-TREE", plan[i_scan + 1])
+
+    def test_plan_stable_with_rows_present(self):
+        # Plano não deve mudar com a tabela pequena ou com linhas presentes
+        for _ in range(3):
+            enqueue(db_path=self.db_path, payload="{}", now_fn=self.clock.now)
+            self.clock.advance(seconds=1)
+        joined = " | ".join(self._plan(_SQL_DEQUEUE_ANY, (0, 1, 0, 1, 1)))
+        self.assertIn("idx_jobs_pollkey", joined)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -9,14 +9,20 @@ from andorinha.clock import FakeClock
 from andorinha.storage import get_conn, migrate, close_thread_connections
 from andorinha.queue import (
     enqueue,
+    enqueue_many,
+    dequeue_batch,
     dequeue_with_lease,
     extend_lease,
     release,
+    _SQL_INSERT_JOB,
+    _fmt_iso,
+    _ms,
 )
 
 def parse_iso_z(s: str) -> datetime:
     # Converte "YYYY-MM-DDTHH:MM:SS.mmmZ" para datetime aware UTC
-    return datetime.fromisoformat(s.replace("Z", "+00:00"))
+    # (fatia o "Z" final em vez de str.replace — posição fixa, sem scan)
+    return datetime.fromisoformat(s[:-1] + "+00:00")
 
 class TestQueueLeasing(unittest.TestCase):
     def setUp(self):
@@ -32,13 +38,34 @@ class TestQueueLeasing(unittest.TestCase):
         close_thread_connections()
         self.tmp.cleanup()
 
+    def _bulk_enqueue(self, rows, queue="default"):
+        # rows: [(priority, payload, offset_s), ...]. Avança o FakeClock por
+        # tupla, mas grava tudo em um único executemany + 1 commit (1 fsync
+        # em vez de N — inserts por linha dominam o custo do suite em WAL).
+        params = []
+        for prio, payload, offset_s in rows:
+            if offset_s:
+                self.clock.advance(seconds=offset_s)
+            t = self.clock.now()
+            created = _fmt_iso(t)
+            created_ms = _ms(t)
+            params.append(
+                ("queued", prio, queue, payload, 0, 1,
+                 None, None, None, None, None,
+                 created, created,
+                 None, None, created_ms, created_ms)
+            )
+        self.conn.execute("BEGIN;")
+        self.conn.executemany(_SQL_INSERT_JOB, params)
+        last = int(self.conn.execute("SELECT last_insert_rowid();").fetchone()[0])
+        self.conn.commit()
+        return list(range(last - len(params) + 1, last + 1))
+
     def test_priority_and_fifo(self):
         # A: prio 5, B: prio 1, C: prio 1 (B antes de C por created_at)
-        enqueue(db_path=self.db_path, queue="emails", priority=5, payload="{}", now_fn=self.clock.now)
-        self.clock.advance(seconds=1)
-        idB = enqueue(db_path=self.db_path, queue="emails", priority=1, payload="{}", now_fn=self.clock.now)
-        self.clock.advance(seconds=1)
-        idC = enqueue(db_path=self.db_path, queue="emails", priority=1, payload="{}", now_fn=self.clock.now)
+        _, idB, idC = self._bulk_enqueue(
+            [(5, "{}", 0), (1, "{}", 1), (1, "{}", 1)], queue="emails"
+        )
 
         # Dequeue deve pegar B, depois C
         j1 = dequeue_with_lease(60, db_path=self.db_path, queue="emails", now_fn=self.clock.now)
@@ -49,6 +76,75 @@ class TestQueueLeasing(unittest.TestCase):
         self.assertIsNotNone(j2)
         self.assertEqual(j2["id"], idC)
 
+    def test_enqueue_many_bulk(self):
+        ids = enqueue_many(
+            [
+                {"queue": "emails", "priority": 1, "payload": "{}"},
+                {"queue": "emails", "priority": 2, "payload": "{}"},
+                {"queue": "emails", "priority": 3, "payload": "{}"},
+            ],
+            db_path=self.db_path,
+            now_fn=self.clock.now,
+        )
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids, sorted(ids))
+        count = self.conn.execute("SELECT COUNT(*) AS c FROM jobs;").fetchone()["c"]
+        self.assertEqual(count, 3)
+
+        # Prioridade menor sai primeiro
+        j = dequeue_with_lease(60, db_path=self.db_path, queue="emails", now_fn=self.clock.now)
+        self.assertIsNotNone(j)
+        self.assertEqual(j["id"], ids[0])
+
+        # Lista vazia é no-op
+        self.assertEqual(enqueue_many([], db_path=self.db_path), [])
+
+    def test_dequeue_batch_claims_in_order(self):
+        idA = enqueue(db_path=self.db_path, priority=2, payload="{}", now_fn=self.clock.now)
+        self.clock.advance(seconds=1)
+        idB = enqueue(db_path=self.db_path, priority=1, payload="{}", now_fn=self.clock.now)
+        self.clock.advance(seconds=1)
+        idC = enqueue(db_path=self.db_path, priority=1, payload="{}", now_fn=self.clock.now)
+
+        # Lote de 2: leva B e C (prioridade 1), em ordem FIFO
+        rows = dequeue_batch(2, 60, db_path=self.db_path, now_fn=self.clock.now)
+        self.assertEqual([r["id"] for r in rows], [idB, idC])
+        for r in rows:
+            self.assertEqual(r["status"], "leased")
+
+        # Sobrou apenas A
+        rest = dequeue_batch(5, 60, db_path=self.db_path, now_fn=self.clock.now)
+        self.assertEqual([r["id"] for r in rest], [idA])
+
+        # Fila vazia -> lista vazia
+        self.assertEqual(dequeue_batch(3, 60, db_path=self.db_path, now_fn=self.clock.now), [])
+
+    def test_dequeue_fetch_payload_false_omits_payload(self):
+        jid = enqueue(db_path=self.db_path, payload='{"x":1}', now_fn=self.clock.now)
+        j = dequeue_with_lease(
+            60, db_path=self.db_path, fetch_payload=False, now_fn=self.clock.now
+        )
+        self.assertIsNotNone(j)
+        self.assertEqual(j["id"], jid)
+
+        # Conjunto de colunas meta estável — sem 'payload'
+        expected = {
+            "id", "status", "priority", "queue", "attempt", "max_attempts",
+            "scheduled_at", "lease_expires_at", "rate_group", "cron",
+            "next_run_at", "created_at", "updated_at",
+            "scheduled_at_ms", "lease_expires_at_ms", "created_at_ms",
+            "updated_at_ms", "poll_key",
+        }
+        self.assertEqual(set(j.keys()), expected)
+
+        # Coluna ausente em sqlite3.Row levanta IndexError (documentado)
+        with self.assertRaises(IndexError):
+            j["payload"]
+
+        # O payload segue íntegro no banco, para busca sob demanda
+        row = self.conn.execute("SELECT payload FROM jobs WHERE id=?;", (jid,)).fetchone()
+        self.assertEqual(row["payload"], '{"x":1}')
+
     def test_scheduled_at_respected(self):
         # Job agendado para +10 minutos
         future = (self.clock.now() + timedelta(minutes=10)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
@@ -116,16 +212,29 @@ class TestQueueLeasing(unittest.TestCase):
         self.assertIsNotNone(j)
 
         # sucesso
-        release(jid, success=True, db_path=self.db_path, now_fn=self.clock.now)
-        st = self.conn.execute("SELECT status, attempt FROM jobs WHERE id=?;", (jid,)).fetchone()
+        self.assertTrue(release(jid, success=True, db_path=self.db_path, now_fn=self.clock.now))
+        st = self.conn.execute(
+            "SELECT status, attempt, updated_at_ms FROM jobs WHERE id=?;", (jid,)
+        ).fetchone()
         self.assertEqual(st["status"], "succeeded")
         self.assertEqual(st["attempt"], 0)
 
+        # release repetido/atrasado é no-op: retorna False e não toca a linha
+        self.clock.advance(seconds=5)
+        self.assertFalse(release(jid, success=True, db_path=self.db_path, now_fn=self.clock.now))
+        self.assertFalse(release(jid, success=False, db_path=self.db_path, now_fn=self.clock.now))
+        again = self.conn.execute(
+            "SELECT status, attempt, updated_at_ms FROM jobs WHERE id=?;", (jid,)
+        ).fetchone()
+        self.assertEqual(again["status"], "succeeded")
+        self.assertEqual(again["attempt"], st["attempt"])
+        self.assertEqual(again["updated_at_ms"], st["updated_at_ms"])
+
         # Re-enfileira e falha
         jid2 = enqueue(db_path=self.db_path, payload="{}", now_fn=self.clock.now)
         j2 = dequeue_with_lease(30, db_path=self.db_path, now_fn=self.clock.now)
         self.assertIsNotNone(j2)
-        release(jid2, success=False, db_path=self.db_path, now_fn=self.clock.now)
+        self.assertTrue(release(jid2, success=False, db_path=self.db_path, now_fn=self.clock.now))
         st2 = self.conn.execute("SELECT status, attempt FROM jobs WHERE id=?;", (jid2,)).fetchone()
         self.assertEqual(st2["status"], "queued")
         self.assertEqual(st2["attempt"], 1)
@@ -8,11 +8,14 @@ from andorinha import clock
 from andorinha import logging as and_logging
 from andorinha import __all__ as pkg_export  # sanity of package exports
 from andorinha.storage import (
+    SCHEMA_V1,
     get_conn,
     migrate,
+    transaction,
     close_thread_connections,
     utc_now_str,
 )
+from andorinha.queue import enqueue, dequeue_with_lease
 
 class TestStorageBootstrap(unittest.TestCase):
     def setUp(self):
@@ -31,6 +34,18 @@ class TestStorageBootstrap(unittest.TestCase):
         fk = self.conn.execute("PRAGMA foreign_keys;").fetchone()[0]
         self.assertEqual(int(fk), 1, "foreign_keys deve estar ON")
 
+        # PRAGMAs de desempenho aplicados por _configure_connection
+        sync = self.conn.execute("PRAGMA synchronous;").fetchone()[0]
+        self.assertEqual(int(sync), 1, "synchronous deve ser NORMAL em WAL")
+        temp = self.conn.execute("PRAGMA temp_store;").fetchone()[0]
+        self.assertEqual(int(temp), 2, "temp_store deve ser MEMORY")
+        cache = self.conn.execute("PRAGMA cache_size;").fetchone()[0]
+        self.assertEqual(int(cache), -65536, "cache_size deve ser 64 MiB")
+        ckpt = self.conn.execute("PRAGMA wal_autocheckpoint;").fetchone()[0]
+        self.assertEqual(int(ckpt), 2000)
+        busy = self.conn.execute("PRAGMA busy_timeout;").fetchone()[0]
+        self.assertEqual(int(busy), 5000)
+
     def test_tables_exist_and_columns_subset(self):
         # Tabelas esperadas
         names = {r["name"] for r in self.conn.execute(
@@ -86,14 +101,116 @@ class TestStorageBootstrap(unittest.TestCase):
                 ("nope", 0, "default", tnow, tnow)
             )
 
+    def test_transaction_commit_rollback_and_defer_fk(self):
+        # commit no sucesso
+        with transaction(self.conn) as c:
+            c.execute(
+                "INSERT INTO workers(name, last_heartbeat) VALUES ('w1', ?);",
+                (utc_now_str(),),
+            )
+        n = self.conn.execute("SELECT COUNT(*) FROM workers;").fetchone()[0]
+        self.assertEqual(n, 1)
+
+        # rollback quando o corpo levanta
+        with self.assertRaises(RuntimeError):
+            with transaction(self.conn) as c:
+                c.execute(
+                    "INSERT INTO workers(name, last_heartbeat) VALUES ('w2', ?);",
+                    (utc_now_str(),),
+                )
+                raise RuntimeError("boom")
+        n = self.conn.execute("SELECT COUNT(*) FROM workers;").fetchone()[0]
+        self.assertEqual(n, 1)
+
+        # defer_fk=True adia a validação de FK para o COMMIT: um run órfão
+        # pode existir dentro da transação, desde que resolvido antes do fim
+        with transaction(self.conn, defer_fk=True) as c:
+            self.assertEqual(
+                c.execute("PRAGMA defer_foreign_keys;").fetchone()[0], 1
+            )
+            c.execute(
+                "INSERT INTO runs(job_id, started_at) VALUES (999999, ?);",
+                (utc_now_str(),),
+            )
+            c.execute("DELETE FROM runs WHERE job_id = 999999;")
+
+        # fora da transação o pragma reseta e a FK volta a valer na hora
+        self.assertEqual(
+            self.conn.execute("PRAGMA defer_foreign_keys;").fetchone()[0], 0
+        )
+        with self.assertRaises(sqlite3.IntegrityError):
+            with transaction(self.conn) as c:
+                c.execute(
+                    "INSERT INTO runs(job_id, started_at) VALUES (999999, ?);",
+                    (utc_now_str(),),
+                )
+
+    def test_migrate_upgrades_genuine_v1_database(self):
+        # Banco "de época": apenas o script v1 aplicado (sem colunas *_ms),
+        # com linhas legadas só em TEXT — o formato que migrate() encontra
+        # em deployments reais parados na versão 1.
+        legacy = os.path.join(self.tmp.name, "legacy.db")
+        raw = sqlite3.connect(legacy)
+        raw.executescript(SCHEMA_V1)
+        raw.execute("INSERT INTO schema_migrations(version) VALUES (1);")
+        raw.execute(
+            """INSERT INTO jobs(status, priority, queue, payload,
+                                scheduled_at, lease_expires_at,
+                                created_at, updated_at)
+               VALUES ('queued', 1, 'emails', '{}',
+                       '2099-01-01T00:00:00.500Z', NULL,
+                       '2024-01-01T10:20:30.123Z', '2024-01-01T10:20:30.123Z');"""
+        )
+        cols = [r[1] for r in raw.execute("PRAGMA table_info('jobs');")]
+        self.assertNotIn("created_at_ms", cols)
+        raw.commit()
+        raw.close()
+
+        conn = get_conn(legacy)
+        self.assertEqual(migrate(conn), 3)
+
+        # Backfill: epoch-ms derivado do TEXT, NULL preservado
+        row = conn.execute("SELECT * FROM jobs;").fetchone()
+        self.assertEqual(row["created_at_ms"], 1704104430123)
+        self.assertEqual(row["scheduled_at_ms"], 4070908800500)
+        self.assertIsNone(row["lease_expires_at_ms"])
+
+        # Semântica pós-migração: agendado no futuro continua retido
+        self.assertIsNone(dequeue_with_lease(60, db_path=legacy))
+
+    def test_backfill_expression_agrees_with_writer(self):
+        # A expressão de backfill do v2 e o caminho de escrita devem
+        # concordar: recalcular *_ms a partir do TEXT reproduz exatamente o
+        # que enqueue gravou (fidelidade de milissegundo, sem arredondar).
+        clk = clock.FakeClock()
+        clk.set(datetime(2024, 6, 30, 23, 59, 59, 999000, tzinfo=timezone.utc))
+        enqueue(
+            db_path=self.db_path,
+            payload="{}",
+            scheduled_at="2024-07-01T00:00:00.001Z",
+            now_fn=clk.now,
+        )
+        row = self.conn.execute(
+            """SELECT created_at_ms, scheduled_at_ms,
+                      CAST(strftime('%s', created_at) AS INTEGER) * 1000
+                      + CAST(substr(created_at, 21, 3) AS INTEGER) AS created_rt,
+                      CAST(strftime('%s', scheduled_at) AS INTEGER) * 1000
+                      + CAST(substr(scheduled_at, 21, 3) AS INTEGER) AS scheduled_rt
+               FROM jobs;"""
+        ).fetchone()
+        self.assertEqual(row["created_at_ms"], row["created_rt"])
+        self.assertEqual(row["created_at_ms"], 1719791999999)
+        self.assertEqual(row["scheduled_at_ms"], row["scheduled_rt"])
+        self.assertEqual(row["scheduled_at_ms"], 1719792000001)
+
     def test_migrate_is_idempotent_and_version_stable(self):
-        # Rodar de novo não deve mudar nada
+        # Rodar de novo não deve mudar nada (versão corrente = 3)
         v1 = self.conn.execute("SELECT MAX(version) FROM schema_migrations;").fetchone()[0]
         v2 = migrate(self.conn)
         v3 = self.conn.execute("SELECT MAX(version) FROM schema_migrations;").fetchone()[0]
-        self.assertEqual(v1, 1)
-        self.assertEqual(v2, 1)
-        self.assertEqual(v3, 1)
+        self.assertEqual(v1, 3)
+        self.assertEqual(v2, 3)
+        self.assertEqual(v3, 3)
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
\ No newline at end of file